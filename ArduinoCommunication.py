@@ -12,6 +12,9 @@ The key functions are:
 - sendToArduino(str, serialInstance) which sends the given string to the Arduino. 
 The string may contain characters with any of the values 0 to 255.
 
+- isReplyTo(reply, command) which checks that a reply received from the 
+Arduino ("Axis RA newVel 200 Time 3 s") belongs to the given command ("<RA,200>").
+
 - recvFromArduino(serialInstance)  which returns an array. The first element 
 contains the number of bytes that the Arduino said it included in message. This
 can be used to check that the full message was received. The second element 
@@ -46,6 +49,7 @@ marianobarella@gmail.com
 import time
 import sys
 import glob
+import re
 import serial
 
 startMarker = 60
@@ -93,11 +97,37 @@ def serial_ports():
 
 #======================================
 
+def checkSpeed(speed):
+    checkedSpeed = 0
+    if speed < -255:
+        print("\nSpeed can't be LOWER than -255")
+        print("Forcing speed to -255")
+        checkedSpeed = -255
+    elif speed > 255:
+        print("\nSpeed can't be HIGHER than +255")
+        print("Forcing speed to +255")
+        checkedSpeed = 255
+    else:
+        checkedSpeed = speed
+    return checkedSpeed
+
+#======================================
+
 def sendToArduino(sendStr, ser):
     ser.write(sendStr.encode('utf-8'))
 
 #======================================
 
+def isReplyTo(reply, command):
+    content = command.strip().lstrip('<').rstrip('>').split(',')
+    if len(content) != 2:
+        return False
+    axis, speed = content[0], content[1].strip()
+    pattern = r"Axis\s+%s\s+newVel\s+%s\b" % (re.escape(axis), re.escape(speed))
+    return re.search(pattern, reply) is not None
+
+#======================================
+
 def recvFromArduino(serialInstace):
     global startMarker, endMarker
     
@@ -106,12 +136,13 @@ def recvFromArduino(serialInstace):
     byteCount = -1 # to allow for the fact that the last increment will be one too many
     
     # wait for the start character
-    while  ord(x) != startMarker: 
+    # (an empty read means the port timeout expired, keep waiting)
+    while len(x) == 0 or ord(x) != startMarker: 
         x = serialInstace.read()
     
     # save data until the end marker is found
-    while ord(x) != endMarker:
-        if ord(x) != startMarker:
+    while len(x) == 0 or ord(x) != endMarker:
+        if len(x) > 0 and ord(x) != startMarker:
             ck = ck + x.decode("utf-8")
             byteCount += 1
         x = serialInstace.read()
@@ -193,8 +224,9 @@ def sendListOfCommand(td, serialInstace):
 
 #======================================
 
-def initSerial(port, baudRate):
-    ser = serial.Serial(port, baudRate)
+def initSerial(port, baudRate, timeout=None):
+    # timeout in seconds for each read, None waits forever
+    ser = serial.Serial(port, baudRate, timeout=timeout)
     return(ser)
 
 #======================================
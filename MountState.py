@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Mount state publication module
+Publish the current state of the mount (R.A. and Dec speeds and serial
+connection) into a shared-memory segment so other programs running on the
+observing machine (capture, plate-solving, logging) can read it without
+parsing the GUI output and without touching the serial port.
+
+The key classes are:
+- MountStateWriter(), used by the telescope_gui Backend. It creates the segment
+and publishes every change with publish(...).
+
+- MountStateReader(), used by any other program. It attaches to the segment and
+returns the last published state with read(). Reads never block the writer.
+
+Segment layout (little-endian, fixed size, name "telescope_mount_state"):
+    offset  type       field
+    0       4 bytes    magic "TLSC"
+    4       uint16     layout version
+    6       uint16     reserved
+    8       uint64     sequence number (seqlock)
+    16      int32      process id of the writer
+    20      4 bytes    padding
+    24      float64    time of the last update (seconds since epoch)
+    32      int32      R.A. speed (-255 to +255)
+    36      int32      Dec speed (-255 to +255)
+    40      int32      baud rate
+    44      uint8      connected (0 or 1)
+    45      3 bytes    padding
+    48      64 bytes   serial port name (utf-8, null padded)
+
+The sequence number works as a seqlock: the writer makes it odd before changing
+the data and even again when it's done. A reader copies the data between two
+reads of the sequence number and retries if they differ or are odd. This way
+the writer never waits for the readers.
+
+NOTES:
+- Requires Python 3.8 or newer (multiprocessing.shared_memory).
+- Only one writer per machine is allowed (one program owns the serial port).
+A second MountStateWriter, even in the same process, refuses to start while
+the writer process recorded in the segment is alive. A segment left by a
+writer that died is taken over, and its sequence number is continued.
+- When the writer closes, it publishes connected = False with both speeds at 0
+and clears its process id before removing the segment. A reader that is still
+attached can check writerAlive() (or state.writerPid, 0 once closed) and
+attach again to the segment of a new writer.
+
+Example of a reader:
+       import MountState
+       reader = MountState.MountStateReader()
+       state = reader.read()
+       print(state.raSpeed, state.decSpeed, state.connected)
+       reader.close()
+
+@author: Mariano Barella
+marianobarella@gmail.com
+
+"""
+
+import os
+import sys
+import time
+import struct
+from collections import namedtuple
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+segmentName = "telescope_mount_state"
+layoutVersion = 2
+magic = b"TLSC"
+
+headerStruct = struct.Struct("<4sHHQi4x")
+dataStruct = struct.Struct("<diiiB3x64s")
+seqStruct = struct.Struct("<Q")
+seqOffset = 8
+dataOffset = headerStruct.size
+segmentSize = headerStruct.size + dataStruct.size
+
+MountState = namedtuple("MountState", ["sequence", "timestamp", "raSpeed",
+                                       "decSpeed", "baudRate", "connected",
+                                       "port", "writerPid"])
+pidStruct = struct.Struct("<i")
+pidOffset = 16
+
+#=====================================
+
+#  Function Definitions
+
+#=====================================
+
+def checkSize(shm, name):
+    if shm.size < segmentSize:
+        shm.close()
+        raise ValueError("Shared memory segment %s is too small" % name)
+    return shm
+
+#======================================
+
+def createSegment(name):
+    """Create the shared-memory segment for the writer
+
+    Returns the segment and True if it was created, False if it already
+    existed. In both cases it is registered in the resource tracker, as the
+    writer removes it on close.
+    """
+    if shared_memory is None:
+        raise EnvironmentError("Shared memory requires Python 3.8 or newer")
+
+    try:
+        shm = shared_memory.SharedMemory(name, create=True, size=segmentSize)
+        return shm, True
+    except FileExistsError:
+        shm = shared_memory.SharedMemory(name)
+        return checkSize(shm, name), False
+
+#======================================
+
+def attachSegment(name):
+    """Attach to an existing shared-memory segment for a reader
+
+    The reader side is not registered in the resource tracker, otherwise the
+    segment would be removed when the reader exits.
+    """
+    if shared_memory is None:
+        raise EnvironmentError("Shared memory requires Python 3.8 or newer")
+
+    try:
+        shm = shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Python older than 3.13: skip the registration. Unregistering
+        # afterwards would also drop the writer's entry when both live in
+        # the same process
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            shm = shared_memory.SharedMemory(name)
+        finally:
+            resource_tracker.register = register
+
+    return checkSize(shm, name)
+
+#======================================
+
+def processAlive(pid):
+    """Return True if a process with the given id is running"""
+    if pid <= 0:
+        return False
+    if sys.platform.startswith('win'):
+        # os.kill would terminate it. A Windows segment only exists while
+        # some process has it open, so assume the owner is alive
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    except OSError:
+        return False
+    return True
+
+#======================================
+
+class MountStateWriter(object):
+    """Publish the mount state into the shared-memory segment"""
+
+    def __init__(self, name=segmentName):
+        self.shm, created = createSegment(name)
+        self.seq = 0
+        if not created:
+            self.seq = self.takeOver(name)
+        self.buf = self.shm.buf
+        self.state = {"raSpeed": 0, "decSpeed": 0, "baudRate": 0,
+                      "connected": False, "port": ""}
+        headerStruct.pack_into(self.buf, 0, magic, layoutVersion, 0, self.seq,
+                               os.getpid())
+        self.publish()
+
+    def takeOver(self, name):
+        """Check that an existing segment can be reused
+
+        Returns the sequence number to continue from. Raises an error if
+        another writer is alive or the segment isn't a mount state.
+        """
+        segMagic, version, _, seq, ownerPid = headerStruct.unpack_from(self.shm.buf, 0)
+        if segMagic == magic and version == layoutVersion:
+            if processAlive(ownerPid):
+                self.shm.close()
+                raise EnvironmentError("Mount state is already published by "
+                                       "process %d" % ownerPid)
+            # round up to even, a dead writer may have left it odd
+            return seq + (seq % 2)
+        if segMagic == magic:
+            self.shm.close()
+            raise ValueError("Shared memory segment %s has layout version %d "
+                             "(expected %d), remove it if no other program is "
+                             "using it" % (name, version, layoutVersion))
+        if segMagic != bytes(4):
+            self.shm.close()
+            raise ValueError("Shared memory segment %s is used by another "
+                             "program" % name)
+        # created by a writer that died before writing the header
+        return 0
+
+    def publish(self, **fields):
+        """Update the given fields and publish the whole state
+
+        Accepted fields: raSpeed, decSpeed, baudRate, connected, port.
+        Fields that are not given keep their last published value.
+        """
+        for key in fields:
+            if key not in self.state:
+                raise KeyError("Unknown mount state field: %s" % key)
+        if self.buf is None:
+            # already closed
+            return
+        self.state.update(fields)
+        s = self.state
+
+        # odd sequence number: update in progress
+        self.seq += 1
+        seqStruct.pack_into(self.buf, seqOffset, self.seq)
+        dataStruct.pack_into(self.buf, dataOffset, time.time(),
+                             int(s["raSpeed"]), int(s["decSpeed"]),
+                             int(s["baudRate"]), 1 if s["connected"] else 0,
+                             s["port"].encode("utf-8")[:64])
+        # even sequence number: data is consistent
+        self.seq += 1
+        seqStruct.pack_into(self.buf, seqOffset, self.seq)
+
+    def close(self):
+        """Publish a disconnected state and remove the segment
+
+        Readers still attached see connected = False, zero speeds and no
+        writer process.
+        """
+        if self.buf is None:
+            return
+        self.publish(raSpeed=0, decSpeed=0, connected=False)
+        pidStruct.pack_into(self.buf, pidOffset, 0)
+        self.buf = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+#======================================
+
+class MountStateReader(object):
+    """Read the mount state published by a MountStateWriter
+
+    The data is unpacked directly from the shared buffer, nothing else is
+    copied and no lock is taken.
+    """
+
+    def __init__(self, name=segmentName):
+        self.shm = attachSegment(name)
+        self.buf = self.shm.buf
+        segMagic, version, _, _, _ = headerStruct.unpack_from(self.buf, 0)
+        if segMagic != magic:
+            self.close()
+            raise ValueError("Shared memory segment %s is not a mount state" % name)
+        if version != layoutVersion:
+            self.close()
+            raise ValueError("Mount state layout version %d not supported "
+                             "(expected %d)" % (version, layoutVersion))
+
+    def sequence(self):
+        """Return the current sequence number, it changes on every update"""
+        return seqStruct.unpack_from(self.buf, seqOffset)[0]
+
+    def writerPid(self):
+        """Return the process id of the writer, 0 if it closed the segment"""
+        return pidStruct.unpack_from(self.buf, pidOffset)[0]
+
+    def writerAlive(self):
+        """Return False if the writer closed the segment or died
+
+        The segment is then stale: close this reader and create a new one
+        once a new writer is running.
+        """
+        return processAlive(self.writerPid())
+
+    def read(self, timeout=1.0):
+        """Return the last consistent MountState
+
+        Retries while the writer is updating the segment. Raises TimeoutError
+        if no consistent copy could be taken within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            seq1 = seqStruct.unpack_from(self.buf, seqOffset)[0]
+            if seq1 % 2 == 0:
+                data = dataStruct.unpack_from(self.buf, dataOffset)
+                seq2 = seqStruct.unpack_from(self.buf, seqOffset)[0]
+                if seq1 == seq2:
+                    timestamp, raSpeed, decSpeed, baudRate, connected, port = data
+                    return MountState(seq1, timestamp, raSpeed, decSpeed,
+                                      baudRate, bool(connected),
+                                      port.rstrip(b"\x00").decode("utf-8", "replace"),
+                                      self.writerPid())
+            if time.monotonic() > deadline:
+                raise TimeoutError("Mount state is being updated for too long")
+            # odd for long if the writer died in the middle of an update
+            time.sleep(0.0002)
+
+    def close(self):
+        """Detach from the segment (it is not removed)"""
+        self.buf = None
+        self.shm.close()
+
+#======================================
+
+if __name__ == '__main__':
+
+    # print the mount state every time it changes, attach again when the
+    # writer is restarted
+    reader = None
+    lastSeq = -1
+    try:
+        while True:
+            if reader is None:
+                try:
+                    reader = MountStateReader()
+                    lastSeq = -1
+                except (FileNotFoundError, ValueError):
+                    time.sleep(1)
+                    continue
+            if reader.sequence() != lastSeq:
+                try:
+                    state = reader.read()
+                    lastSeq = state.sequence
+                    print(state)
+                except TimeoutError as e:
+                    print(e)
+            if not reader.writerAlive():
+                print('Writer is gone, waiting for a new one')
+                reader.close()
+                reader = None
+                continue
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    if reader is not None:
+        reader.close()
@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Observation sequencer module
+Run timed observation plans on the mount: a plan is a list of steps such as
+"track at rate X for 300 s, nudge DEC -10 for 4 s, stop".
+
+The key functions are:
+- loadPlan(path) which reads a plan from a JSON or YAML (needs PyYAML) file.
+
+- compilePlan(plan) which validates the plan (speeds are checked with
+checkSpeed) and compiles it ahead of time into a flat timeline of serial
+commands. It returns the timeline and the total duration of the plan.
+
+- ObservationSequencer(timeline, duration, serialInstance) which executes the
+timeline in its own thread with start(), pause(), resume() and abort().
+Each command is sent earlier by the measured link latency so it reaches the
+Arduino on time. Scheduled and actual execution times are recorded and can be
+summarized with timingReport().
+
+Plan format (JSON shown, YAML uses the same keys):
+    {"steps": [
+        {"action": "track", "axis": "RA", "speed": 57, "duration": 300},
+        {"action": "nudge", "axis": "DEC", "speed": -10, "duration": 4},
+        {"action": "wait", "duration": 10},
+        {"action": "stop"}
+    ]}
+
+Actions:
+- track: set the speed of an axis and keep it for duration seconds (optional).
+- nudge: set the speed of an axis for duration seconds, then restore the
+previous speed of that axis.
+- wait: keep the current speeds for duration seconds.
+- stop: stop the given axis, or both if no axis is given. Duration is optional.
+
+NOTES:
+- While paused, both axes are stopped and the timeline is frozen. On resume
+the speeds are restored and the rest of the plan is shifted by the pause time.
+- Abort stops both axes.
+- The link latency is the round trip time of a command (command sent, reply
+received) minus the transmission time of the reply at the port baud rate.
+It is updated with every reply.
+- A command whose reply doesn't arrive within replyTimeout seconds aborts
+the sequence.
+
+Usage:
+       python ObservationSequencer.py plan.json /dev/ttyACM0 9600
+
+@author: Mariano Barella
+marianobarella@gmail.com
+
+"""
+
+import sys
+import math
+import json
+import time
+import threading
+from collections import namedtuple
+
+import ArduinoCommunication as ardcom
+from ArduinoCommunication import checkSpeed
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+axisList = ['RA', 'DEC']
+actionList = ['track', 'nudge', 'wait', 'stop']
+
+# time in seconds from the start of the plan, command to send and the
+# speeds of both axis once the command is applied
+TimelineEntry = namedtuple("TimelineEntry", ["time", "axis", "speed",
+                                             "command", "raSpeed", "decSpeed"])
+
+#=====================================
+
+#  Function Definitions
+
+#=====================================
+
+def loadPlan(path):
+    """Read an observation plan from a JSON or YAML file"""
+
+    with open(path, 'r') as f:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            if yaml is None:
+                raise EnvironmentError('PyYAML is needed to read ' + path)
+            plan = yaml.safe_load(f)
+        else:
+            plan = json.load(f)
+    return plan
+
+#======================================
+
+def checkDuration(step, n, required):
+    duration = step.get('duration')
+    if duration is None:
+        if required:
+            raise ValueError('Step %d (%s) needs a duration' % (n, step['action']))
+        return 0.0
+    if isinstance(duration, bool) or not isinstance(duration, (int, float)):
+        raise ValueError('Step %d: duration must be a number' % n)
+    duration = float(duration)
+    if not math.isfinite(duration):
+        raise ValueError('Step %d: duration must be finite' % n)
+    if duration < 0 or (required and duration == 0):
+        raise ValueError('Step %d: duration must be positive' % n)
+    return duration
+
+#======================================
+
+def checkStepSpeed(step, n):
+    speed = step.get('speed')
+    # 57.0 is accepted, 57.9 or true are not
+    if isinstance(speed, float) and math.isfinite(speed) and speed.is_integer():
+        speed = int(speed)
+    if isinstance(speed, bool) or not isinstance(speed, int):
+        raise ValueError('Step %d: speed must be an integer' % n)
+    return checkSpeed(speed)
+
+#======================================
+
+def checkAxis(step, n, required):
+    axis = step.get('axis')
+    if axis is None and not required:
+        return None
+    if axis not in axisList:
+        raise ValueError('Step %d: axis must be one of %s' % (n, axisList))
+    return axis
+
+#======================================
+
+def compilePlan(plan):
+    """Validate a plan and compile it into a timeline of serial commands
+
+    Returns a list of TimelineEntry sorted by time and the duration of the
+    plan in seconds. Commands that don't change the speed of an axis are
+    dropped and, if two commands for the same axis fall at the same time,
+    only the last one is kept.
+    """
+
+    if isinstance(plan, dict):
+        steps = plan.get('steps')
+    else:
+        steps = plan
+    if not isinstance(steps, list):
+        raise ValueError('A plan is a list of steps or a dict with a "steps" list')
+
+    speeds = {'RA': 0, 'DEC': 0}
+    events = [] # [time, axis, speed, speed before this event]
+    t = 0.0
+
+    def setSpeed(axis, speed):
+        previous = speeds[axis]
+        for event in events:
+            if event[0] == t and event[1] == axis:
+                # a later command at the same time replaces it
+                previous = event[3]
+                events.remove(event)
+                break
+        speeds[axis] = speed
+        if speed != previous:
+            events.append([t, axis, speed, previous])
+
+    for n, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get('action') not in actionList:
+            raise ValueError('Step %d: action must be one of %s' % (n, actionList))
+        action = step['action']
+
+        if action == 'track' or action == 'nudge':
+            axis = checkAxis(step, n, True)
+            speed = checkStepSpeed(step, n)
+            duration = checkDuration(step, n, action == 'nudge')
+            previousSpeed = speeds[axis]
+            setSpeed(axis, speed)
+            t += duration
+            if action == 'nudge':
+                setSpeed(axis, previousSpeed)
+
+        elif action == 'wait':
+            t += checkDuration(step, n, True)
+
+        elif action == 'stop':
+            axis = checkAxis(step, n, False)
+            for a in axisList:
+                if axis is None or axis == a:
+                    setSpeed(a, 0)
+            t += checkDuration(step, n, False)
+
+    timeline = []
+    current = {'RA': 0, 'DEC': 0}
+    for eventTime, axis, speed, previous in events:
+        current[axis] = speed
+        timeline.append(TimelineEntry(eventTime, axis, speed,
+                                      "<%s,%d>" % (axis, speed),
+                                      current['RA'], current['DEC']))
+    return timeline, t
+
+#======================================
+
+class ObservationSequencer(object):
+    """Execute a compiled timeline on the Arduino
+
+    Commands are scheduled with time.perf_counter(): the thread sleeps until
+    spinTime seconds before the command is due and then busy-waits.
+
+    serialInstance must have a read timeout so a lost reply can't block the
+    thread. If its timeout is None (pyserial's default, wait forever), it is
+    changed to 0.1 s on the given port object.
+    """
+
+    def __init__(self, timeline, duration, serialInstance, latency=0.0,
+                 spinTime=0.002, replyTimeout=2.0, baudRate=None):
+        self.timeline = timeline
+        self.duration = duration
+        self.ser = serialInstance
+        self.latency = latency # link latency, in seconds
+        self.spinTime = spinTime
+        self.replyTimeout = replyTimeout # in seconds
+        if baudRate is None:
+            baudRate = getattr(serialInstance, 'baudrate', 9600)
+        self.baudRate = baudRate
+
+        # reads must return to check the deadline and the abort flag
+        if getattr(serialInstance, 'timeout', 0) is None:
+            serialInstance.timeout = 0.1
+
+        self.records = []
+        self.speeds = {'RA': 0, 'DEC': 0}
+        self.startTime = None
+        self.pausedTime = 0.0
+
+        self.abortFlag = False
+        self.pauseFlag = False
+        self.wakeEvent = threading.Event()
+        self.thread = None
+
+    # Link ---------------------------------------------------------------------
+
+    def transmissionTime(self, nBytes):
+        # 10 bits per byte: start bit, 8 data bits and stop bit
+        return nBytes * 10.0 / self.baudRate
+
+    def recvReply(self, command, deadline, abortable):
+        """Read frames until the reply to command arrives
+
+        Frames that aren't the reply to command are skipped. Returns None if
+        the deadline passes or, when abortable, if the sequence is aborted.
+        """
+
+        frame = None
+        while True:
+            x = self.ser.read(1)
+            if not x:
+                if abortable and self.abortFlag:
+                    return None
+                if time.perf_counter() > deadline:
+                    return None
+                continue
+            if x == b'<':
+                frame = bytearray()
+            elif x == b'>' and frame is not None:
+                reply = frame.decode('utf-8', 'replace')
+                frame = None
+                if ardcom.isReplyTo(reply, command):
+                    return reply
+            elif frame is not None:
+                frame += x
+
+    def sendAndWait(self, command, abortable=True):
+        """Send a command and wait for its reply
+
+        Returns the time the command was sent, the time its reply was received,
+        the reply and the link time: the round trip minus the transmission time
+        of the reply, i.e. the time the Arduino took to get and apply the
+        command. Raises TimeoutError if no reply arrives within replyTimeout.
+        """
+
+        sentTime = time.perf_counter()
+        ardcom.sendToArduino(command, self.ser)
+        reply = self.recvReply(command, sentTime + self.replyTimeout, abortable)
+        replyTime = time.perf_counter()
+        if reply is None:
+            if abortable and self.abortFlag:
+                raise TimeoutError('Aborted while waiting for the reply to ' + command)
+            raise TimeoutError('No reply to %s after %.1f s' % (command, self.replyTimeout))
+
+        # the reply is much longer than the command, at 9600 baud it takes
+        # most of the round trip, so it's removed instead of halving the round trip
+        replyBytes = len(reply) + 2 # with start and end markers
+        linkTime = max(replyTime - sentTime - self.transmissionTime(replyBytes), 0.0)
+        if self.latency == 0.0:
+            self.latency = linkTime
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * linkTime
+        return sentTime, replyTime, reply, linkTime
+
+    def measureLatency(self, n=5):
+        """Estimate the link latency sending commands that don't move the mount"""
+
+        # the Arduino replies to an unknown axis but doesn't move any motor
+        for i in range(n):
+            self.sendAndWait("<PING,0>")
+        print('Link latency: %.1f ms' % (self.latency * 1000))
+        return self.latency
+
+    def setSpeeds(self, raSpeed, decSpeed):
+        for axis, speed in (('RA', raSpeed), ('DEC', decSpeed)):
+            if self.speeds[axis] != speed:
+                self.sendAndWait("<%s,%d>" % (axis, speed))
+                self.speeds[axis] = speed
+
+    def stopAxes(self):
+        """Stop both axes, whatever their known speed is, ignoring abort"""
+
+        for axis in axisList:
+            try:
+                self.sendAndWait("<%s,0>" % axis, abortable=False)
+                self.speeds[axis] = 0
+            except TimeoutError as e:
+                print('Could not confirm that %s stopped: %s' % (axis, e))
+
+    # Control ------------------------------------------------------------------
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def pause(self):
+        self.pauseFlag = True
+        self.wakeEvent.set()
+
+    def resume(self):
+        self.pauseFlag = False
+        self.wakeEvent.set()
+
+    def abort(self):
+        self.abortFlag = True
+        self.wakeEvent.set()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Scheduler ----------------------------------------------------------------
+
+    def holdPause(self):
+        pauseStart = time.perf_counter()
+        pausedSpeeds = (self.speeds['RA'], self.speeds['DEC'])
+        self.setSpeeds(0, 0)
+        print('Sequence paused')
+        while self.pauseFlag and not self.abortFlag:
+            self.wakeEvent.wait(0.1)
+            self.wakeEvent.clear()
+        if self.abortFlag:
+            return
+        self.setSpeeds(*pausedSpeeds)
+        self.pausedTime += time.perf_counter() - pauseStart
+        print('Sequence resumed')
+
+    def waitUntil(self, planTime, early=0.0):
+        """Wait until planTime (seconds from start, minus early) is reached
+
+        Returns False if the sequence was aborted while waiting.
+        """
+
+        while True:
+            if self.abortFlag:
+                return False
+            if self.pauseFlag:
+                self.holdPause()
+                continue
+            target = self.startTime + self.pausedTime + planTime - early
+            remaining = target - time.perf_counter()
+            if remaining <= 0:
+                return True
+            if remaining > self.spinTime:
+                self.wakeEvent.wait(min(remaining - self.spinTime, 0.1))
+                self.wakeEvent.clear()
+
+    def run(self):
+        self.startTime = time.perf_counter()
+        self.pausedTime = 0.0
+
+        try:
+            for entry in self.timeline:
+                early = self.latency
+                if not self.waitUntil(entry.time, early):
+                    break
+                scheduled = self.startTime + self.pausedTime + entry.time
+                sentTime, replyTime, reply, linkTime = self.sendAndWait(entry.command)
+                self.speeds[entry.axis] = entry.speed
+                self.records.append({'command': entry.command,
+                                     'scheduled': scheduled - self.startTime,
+                                     'sent': sentTime - self.startTime,
+                                     'latency': early,
+                                     'executed': sentTime + linkTime - self.startTime,
+                                     'replied': replyTime - self.startTime,
+                                     'reply': reply})
+                print('%8.3f s  %s' % (entry.time, entry.command))
+            else:
+                self.waitUntil(self.duration)
+        except TimeoutError as e:
+            print(e)
+            self.abortFlag = True
+
+        if self.abortFlag:
+            print('Sequence aborted, stopping both axes')
+            self.stopAxes()
+        else:
+            print('Sequence finished')
+
+    # Timing -------------------------------------------------------------------
+
+    def timingReport(self):
+        """Timing error of the executed commands, in milliseconds
+
+        A command is considered executed when it was sent plus its link time
+        (round trip minus the transmission time of the reply).
+        """
+
+        method = ('executed = sent + round trip - reply transmission time '
+                  '(%d baud)' % self.baudRate)
+        errors = [(r['executed'] - r['scheduled']) * 1000 for r in self.records]
+        if not errors:
+            return {'commands': 0, 'method': method}
+        return {'commands': len(errors),
+                'method': method,
+                'mean': sum(errors) / len(errors),
+                'maxAbs': max(abs(e) for e in errors),
+                'errors': errors}
+
+#======================================
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        print('Usage: python ObservationSequencer.py plan.json port [baud rate]')
+        sys.exit(1)
+
+    planPath = sys.argv[1]
+    serPort = sys.argv[2]
+    baudRate = int(sys.argv[3]) if len(sys.argv) > 3 else 9600
+
+    timeline, duration = compilePlan(loadPlan(planPath))
+    print('Plan compiled: %d commands, %.1f s' % (len(timeline), duration))
+
+    ser = ardcom.initSerial(serPort, baudRate, timeout=0.1)
+    print ("Serial port " + serPort + " opened. Baud rate: " + str(baudRate))
+    ardcom.waitForArduino(ser)
+
+    sequencer = ObservationSequencer(timeline, duration, ser)
+    sequencer.measureLatency()
+    sequencer.start()
+    try:
+        while sequencer.isRunning():
+            sequencer.join(0.5)
+    except KeyboardInterrupt:
+        sequencer.abort()
+        sequencer.join()
+
+    report = sequencer.timingReport()
+    if report['commands'] > 0:
+        print('Timing error: mean %.2f ms, max %.2f ms (%d commands)' %
+              (report['mean'], report['maxAbs'], report['commands']))
+        print(report['method'])
+
+    ardcom.closeSerial(ser)
@@ -0,0 +1,55 @@
+/*
+
+Host stub of the Arduino core, only what ra_and_dec_control.ino uses.
+
+Serial is replaced by two byte queues: rx is filled by the test harness 
+(as if the PC had sent the bytes) and tx collects what the sketch writes. 
+availableForWrite() reports the free room of a 64-byte TX buffer, like the 
+hardware one, so the non-blocking send path can be exercised.
+
+Author: Mariano Barella, marianobarella@gmail.com
+
+*/
+
+#ifndef HOST_ARDUINO_H
+#define HOST_ARDUINO_H
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <string>
+#include <deque>
+
+typedef unsigned char byte;
+typedef bool boolean;
+
+class HostSerial {
+  public:
+    std::deque<char> rx;
+    std::string tx;
+    int txRoom = 64;
+
+    void begin(unsigned long) {}
+    int available() { return rx.size(); }
+    int read() {
+      if (rx.empty()) {
+        return -1;
+      }
+      char x = rx.front();
+      rx.pop_front();
+      return x;
+    }
+    int availableForWrite() { return txRoom; }
+    size_t write(char x) { tx.push_back(x); return 1; }
+    size_t println(const char * msg) { tx += msg; tx += "\r\n"; return strlen(msg) + 2; }
+
+    // helpers for the harness
+    void feed(const char * msg) { rx.insert(rx.end(), msg, msg + strlen(msg)); }
+};
+
+extern HostSerial Serial;
+extern unsigned long hostMillis;
+
+inline unsigned long millis() { return hostMillis; }
+
+#endif
@@ -0,0 +1,33 @@
+/*
+
+Host stub of the CuriosityGym MotorDriver library.
+It only records the last command given to each motor.
+
+Author: Mariano Barella, marianobarella@gmail.com
+
+*/
+
+#ifndef HOST_MOTORDRIVER_H
+#define HOST_MOTORDRIVER_H
+
+#define FORWARD 1
+#define BACKWARD 2
+#define BRAKE 3
+#define RELEASE 4
+
+class MotorDriver {
+  public:
+    int lastMotor = -1;
+    int lastCommand = -1;
+    int lastSpeed = -1;
+    long calls = 0;
+
+    void motor(int nMotor, int command, int speed) {
+      lastMotor = nMotor;
+      lastCommand = command;
+      lastSpeed = speed;
+      calls ++;
+    }
+};
+
+#endif
@@ -0,0 +1,207 @@
+/*
+
+Host-side build of ra_and_dec_control.ino
+
+The sketch is compiled on the PC against the stubs in this folder 
+(Arduino.h and MotorDriver.h) so the parsing and dispatch logic can be 
+checked and the command-processing latency measured without a board.
+
+Build and run with:
+       make test
+       make bench
+
+Author: Mariano Barella, marianobarella@gmail.com
+
+*/
+
+#include "Arduino.h"
+#include <chrono>
+
+HostSerial Serial;
+unsigned long hostMillis = 0;
+
+#include "../ra_and_dec_control.ino"
+
+// -------------------- auxiliary functions
+// -------------------- auxiliary functions
+// -------------------- auxiliary functions
+
+int failures = 0;
+
+void check(bool condition, const char * what) {
+  if (!condition) {
+    printf("FAIL: %s\n", what);
+    failures ++;
+  }
+  else {
+    printf("ok:   %s\n", what);
+  }
+}
+
+void resetSketch() {
+  Serial.rx.clear();
+  Serial.tx.clear();
+  Serial.txRoom = 64;
+  RA = MotorDriver();
+  DE = MotorDriver();
+  newVel = 0;
+  velRA = 0;
+  velDEC = 0;
+  bytesRecvd = 0;
+  readInProgress = false;
+  newInstructionFromPC = false;
+  axis = AXIS_NONE;
+  axisName[0] = 0;
+  txHead = 0;
+  txTail = 0;
+  txDropped = 0;
+}
+
+// -------------------- tests
+// -------------------- tests
+// -------------------- tests
+
+void testSingleCommandInOneLoop() {
+  resetSketch();
+  Serial.feed("<RA,100>");
+  loop();
+  check(Serial.rx.empty(), "whole command is drained in one loop");
+  check(RA.lastCommand == FORWARD && RA.lastSpeed == 100, "RA moves forward at 100");
+  check(DE.calls == 0, "DEC is not touched");
+  check(Serial.tx.find("< Axis RA newVel 100 Time 0 s >") == 0, "reply is sent first");
+  check(Serial.tx.find("Moving RA forward") != std::string::npos, "RA status is sent");
+}
+
+void testSeveralCommandsInOneLoop() {
+  resetSketch();
+  Serial.feed("<DEC,-255><RA,-50><RA,0>");
+  loop();
+  check(DE.lastCommand == BACKWARD && DE.lastSpeed == 255, "DEC moves backward at 255");
+  check(RA.lastCommand == RELEASE && RA.calls == 2, "RA is moved and then released");
+  check(velRA == 0 && velDEC == -255, "speeds are stored");
+}
+
+void testDispatchOnlyOnNewCommand() {
+  resetSketch();
+  Serial.feed("<RA,10>");
+  loop();
+  long calls = RA.calls;
+  for (int i = 0; i < 100; i++) {
+    loop();
+  }
+  check(RA.calls == calls, "no dispatch without a new command");
+}
+
+void testSplitCommand() {
+  resetSketch();
+  Serial.feed("<DE");
+  loop();
+  check(DE.calls == 0, "partial command is not dispatched");
+  Serial.feed("C,42>");
+  loop();
+  check(DE.lastCommand == FORWARD && DE.lastSpeed == 42, "command split across loops");
+}
+
+void testUnknownAxis() {
+  resetSketch();
+  Serial.feed("<FOO,10><RA>");
+  loop();
+  check(RA.calls == 0 && DE.calls == 0, "unknown axis or missing speed is ignored");
+  check(Serial.tx.find("< Axis FOO newVel 10") == 0, "unknown axis is still replied");
+}
+
+int countReplies(const std::string & tx) {
+  int n = 0;
+  size_t pos = 0;
+  while ((pos = tx.find("< Axis ", pos)) != std::string::npos) {
+    n ++;
+    pos ++;
+  }
+  return n;
+}
+
+void testRepliesDoNotBlock() {
+  resetSketch();
+  Serial.txRoom = 0;
+  Serial.feed("<RA,1><RA,-2><RA,3>");
+  loop();
+  check(RA.lastSpeed == 3 && RA.lastCommand == FORWARD, "commands are applied while TX buffer is full");
+  check(Serial.tx.empty(), "nothing is written while TX buffer is full");
+  check(txDropped > 0, "status lines are dropped, not waited for");
+  Serial.txRoom = 10;
+  loop();
+  check(Serial.tx.size() == 10, "only the available TX room is written");
+  Serial.txRoom = 64;
+  for (int i = 0; i < 10; i++) {
+    loop();
+  }
+  check(txHead == txTail, "TX queue is emptied when room is available");
+  check(Serial.tx[0] == '<', "queued reply is sent in order");
+  check(countReplies(Serial.tx) == 3, "every reply is sent");
+}
+
+void testRepliesSurviveBurst() {
+  // the stub Serial.write() never blocks, it stands for a blocking write 
+  // that completes once the hardware buffer has room
+  resetSketch();
+  Serial.txRoom = 0;
+  Serial.feed("<RA,1><RA,-2><RA,3><RA,-4><DEC,5><DEC,-6><DEC,7><DEC,-8><RA,0><DEC,0>");
+  loop();
+  check(RA.lastCommand == RELEASE && DE.lastCommand == RELEASE, "burst of commands is applied");
+  check(txDropped > 0, "status lines are dropped in a burst");
+  Serial.txRoom = 64;
+  for (int i = 0; i < 20; i++) {
+    loop();
+  }
+  check(countReplies(Serial.tx) == 10, "one reply per command in a burst");
+  check(Serial.tx.find("< Axis DEC newVel 0") != std::string::npos, "last reply is sent");
+}
+
+// -------------------- benchmark
+// -------------------- benchmark
+// -------------------- benchmark
+
+void benchmark() {
+  const long n = 1000000;
+  const char * commands[] = {"<RA,57>", "<DEC,-120>", "<RA,0>", "<DEC,0>"};
+
+  resetSketch();
+  auto t0 = std::chrono::steady_clock::now();
+  for (long i = 0; i < n; i++) {
+    Serial.feed(commands[i % 4]);
+    loop();
+    Serial.tx.clear();
+  }
+  auto t1 = std::chrono::steady_clock::now();
+  double ns = std::chrono::duration<double, std::nano>(t1 - t0).count();
+  printf("command processing: %.1f ns per command (%ld commands)\n", ns / n, n);
+
+  resetSketch();
+  t0 = std::chrono::steady_clock::now();
+  for (long i = 0; i < n; i++) {
+    loop();
+  }
+  t1 = std::chrono::steady_clock::now();
+  ns = std::chrono::duration<double, std::nano>(t1 - t0).count();
+  printf("idle loop:          %.1f ns per loop (%ld loops)\n", ns / n, n);
+}
+
+// -------------------- main
+// -------------------- main
+// -------------------- main
+
+int main(int argc, char * argv[]) {
+  if (argc > 1 && strcmp(argv[1], "bench") == 0) {
+    benchmark();
+    return 0;
+  }
+  testSingleCommandInOneLoop();
+  testSeveralCommandsInOneLoop();
+  testDispatchOnlyOnNewCommand();
+  testSplitCommand();
+  testUnknownAxis();
+  testRepliesDoNotBlock();
+  testRepliesSurviveBurst();
+  printf("\n%d failure(s)\n", failures);
+  return failures == 0 ? 0 : 1;
+}
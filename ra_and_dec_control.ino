@@ -48,10 +48,32 @@ byte bytesRecvd = 0;
 boolean readInProgress = false;
 boolean newInstructionFromPC = false;
 
-char axis[buffSize] = {0};
+// the axis is parsed once per instruction, the name is kept for the reply
+enum Axis { AXIS_NONE, AXIS_RA, AXIS_DEC };
+Axis axis = AXIS_NONE;
+char axisName[buffSize] = {0};
+
+// outgoing messages are queued here and sent only when the TX buffer has room
+// so the loop never waits for the serial port (64-byte TX buffer at 9600 baud)
+// status lines never use the last replySize bytes, those are kept for replies
+const int txQueueSize = 192;
+const int replySize = buffSize + 48;
+char txQueue[txQueueSize];
+int txHead = 0;
+int txTail = 0;
+unsigned int txDropped = 0;
 
 unsigned long curMillis;
 
+void getInstructionFromPC();
+void parseInstruction();
+void moveRA();
+void moveDEC();
+void moveMotor();
+void replyToPC();
+void queueToPC(const char * msg, boolean isReply);
+void sendQueueToPC();
+
 // -------------------- config
 // -------------------- config
 // -------------------- config
@@ -70,12 +92,11 @@ void loop() {
   // get time  
   curMillis = millis();
 
-  // Read the instructions and reply
+  // Read all the pending instructions, reply and move motor if needed
   getInstructionFromPC();
-  replyToPC();
   
-  // move motor if needed
-  moveMotor();
+  // send queued replies without blocking
+  sendQueueToPC();
 }
 
 // -------------------- auxiliary functions
@@ -85,8 +106,9 @@ void loop() {
 void getInstructionFromPC() {
 
   // receive instructions from PC and save it into inputBuffer
+  // drain every byte available so a full command is handled in a single loop
     
-  if(Serial.available() > 0) {
+  while (Serial.available() > 0) {
 
     char x = Serial.read();
 
@@ -97,8 +119,10 @@ void getInstructionFromPC() {
       newInstructionFromPC = true;
       // reset buffer
       inputBuffer[bytesRecvd] = 0;
-      // read instruction
+      // read instruction, reply and act on it
       parseInstruction();
+      replyToPC();
+      moveMotor();
     }
     
     if(readInProgress) {
@@ -126,9 +150,29 @@ void parseInstruction() {
   char * strtokIndx; // this is used by strtok() as an index
   
   strtokIndx = strtok(inputBuffer,",");      // get the first part - the axis
-  strcpy(axis, strtokIndx); // copy it to axis
+  if (strtokIndx == NULL) {
+    axisName[0] = 0;
+    axis = AXIS_NONE;
+    return;
+  }
+  strcpy(axisName, strtokIndx); // copy it to axisName
+  
+  // compare the axis only once, here, instead of every loop
+  if (strcmp(axisName, "RA") == 0) {
+    axis = AXIS_RA;
+  }
+  else if (strcmp(axisName, "DEC") == 0) {
+    axis = AXIS_DEC;
+  }
+  else {
+    axis = AXIS_NONE;
+  }
   
   strtokIndx = strtok(NULL, ","); // this continues where the previous call left off
+  if (strtokIndx == NULL) {
+    axis = AXIS_NONE;
+    return;
+  }
   newVel = atoi(strtokIndx);     // convert this part to an integer
   
 }
@@ -145,19 +189,19 @@ void moveRA() {
     
     if (newVel > 0) {
       
-      Serial.println("Moving RA forward");
+      queueToPC("Moving RA forward\r\n", false);
       RA.motor(RAMotorNumber, FORWARD, absVelRA);
     }
     
     else if (newVel < 0) {
       
-      Serial.println("Moving RA backward");
+      queueToPC("Moving RA backward\r\n", false);
       RA.motor(RAMotorNumber, BACKWARD, absVelRA);
     }
     
     else {
       
-      Serial.println("Stop RA");
+      queueToPC("Stop RA\r\n", false);
       RA.motor(RAMotorNumber, RELEASE, 0);
     }
   }
@@ -176,17 +220,17 @@ void moveDEC() {
     absVelDEC = abs(newVel);
     
     if (newVel > 0) {
-      Serial.println("Moving DEC forward");
+      queueToPC("Moving DEC forward\r\n", false);
       DE.motor(DECMotorNumber, FORWARD, absVelDEC);
     }
     
     else if (newVel < 0) {
-      Serial.println("Moving DEC backward");
+      queueToPC("Moving DEC backward\r\n", false);
       DE.motor(DECMotorNumber, BACKWARD, absVelDEC);
     }
     
     else {
-      Serial.println("Stop DEC");
+      queueToPC("Stop DEC\r\n", false);
       DE.motor(DECMotorNumber, RELEASE, 0);
     }
 
@@ -200,12 +244,15 @@ void moveMotor() {
 
   // set the speed of the selected axis
   
-  if (strcmp(axis, "RA") == 0) {
-     moveRA();
-  }
-
-  if (strcmp(axis, "DEC") == 0) {
-     moveDEC();
+  switch (axis) {
+    case AXIS_RA:
+      moveRA();
+      break;
+    case AXIS_DEC:
+      moveDEC();
+      break;
+    default:
+      break;
   }
 
 }
@@ -216,13 +263,55 @@ void replyToPC() {
 
   if (newInstructionFromPC) {
     newInstructionFromPC = false;
-    Serial.print("< Axis ");
-    Serial.print(axis);
-    Serial.print(" newVel ");
-    Serial.print(newVel);
-    Serial.print(" Time ");
-    Serial.print(curMillis >> 10); // divide by 512 is approx = half-seconds
-    Serial.println(" s >");
+    char reply[replySize];
+    snprintf(reply, sizeof(reply), "< Axis %s newVel %d Time %lu s >\r\n",
+             axisName, newVel, curMillis >> 10); // divide by 1024 is approx = seconds
+    queueToPC(reply, true);
+  }
+}
+
+//=============
+
+void queueToPC(const char * msg, boolean isReply) {
+
+  // copy a message into the TX queue, it is sent later by sendQueueToPC()
+  // a status line that doesn't fit is dropped entirely (never sent half-way)
+  // a reply is never dropped: the PC waits for one reply per instruction, 
+  // so if the queue is full it is emptied with blocking writes as before
+
+  int len = strlen(msg);
+  int used = (txHead - txTail + txQueueSize) % txQueueSize;
+  int room = txQueueSize - 1 - used;
+  
+  if (!isReply && len > room - replySize) {
+    txDropped ++;
+    return;
+  }
+  
+  if (isReply && len > room) {
+    while (txTail != txHead) {
+      Serial.write(txQueue[txTail]);
+      txTail = (txTail + 1) % txQueueSize;
+    }
+  }
+  
+  for (int i = 0; i < len; i++) {
+    txQueue[txHead] = msg[i];
+    txHead = (txHead + 1) % txQueueSize;
+  }
+}
+
+//=============
+
+void sendQueueToPC() {
+
+  // write only as many bytes as the hardware TX buffer can take right now
+
+  int room = Serial.availableForWrite();
+  while (room > 0 && txTail != txHead) {
+    Serial.write(txQueue[txTail]);
+    txTail = (txTail + 1) % txQueueSize;
+    room --;
   }
 }
 
@@ -15,29 +15,21 @@ marianobarella@gmail.com
 
 """
 
-#import sys
+import sys
 #from datetime import datetime
 
 import ArduinoCommunication as ardcom
+from ArduinoCommunication import checkSpeed
+import MountState
 #
 from PyQt5.QtCore import pyqtSignal, pyqtSlot
+try:
+    from PyQt5.QtSerialPort import QSerialPort
+except ImportError:
+    QSerialPort = None
 from pyqtgraph.Qt import QtCore, QtGui
 from pyqtgraph.dockarea import DockArea, Dock
 
-def checkSpeed(speed):
-    checkedSpeed = 0
-    if speed < -255:
-        print("\nSpeed can't be LOWER than -255")
-        print("Forcing speed to -255")
-        checkedSpeed = -255
-    elif speed > 255:
-        print("\nSpeed can't be HIGHER than +255")
-        print("Forcing speed to +255")
-        checkedSpeed = 255
-    else:
-        checkedSpeed = speed
-    return checkedSpeed
-
 def setDarkTheme():
     palette = QtGui.QPalette()
     palette.setColor(QtGui.QPalette.Window, QtGui.QColor(53,53,53))
@@ -429,6 +421,14 @@ class Backend(QtCore.QObject):
 
     def __init__(self, *args, **kwargs):
         super(Backend, self).__init__(*args, **kwargs)
+        
+        # publish mount state for other programs (see MountState.py)
+        try:
+            self.mountState = MountState.MountStateWriter()
+            print('\nMount state published at shared memory:', MountState.segmentName)
+        except (EnvironmentError, ValueError) as e:
+            self.mountState = None
+            print('\nMount state will not be published:', e)
      
     @pyqtSlot(list)
     def initSerialComm(self, serialInfo):
@@ -449,6 +449,8 @@ class Backend(QtCore.QObject):
         self.ser = ardcom.initSerial(serialParams[0], serialParams[1])
         print('\nSerial port opened:', self.ser.isOpen(), '\n')
         ardcom.waitForArduino(self.ser)
+        self.publishState(connected=True, port=serialParams[0],
+                          baudRate=serialParams[1])
         
     @pyqtSlot()
     def closeSerial(self):
@@ -457,6 +459,7 @@ class Backend(QtCore.QObject):
         # baud rate (int) at serialParams[1]
         self.ser.close()
         print('\nSerial port opened:', self.ser.isOpen(), '\n')            
+        self.publishState(connected=False)
 
     @pyqtSlot(list)
     def setDo(self, axisAndSpeed):
@@ -473,6 +476,21 @@ class Backend(QtCore.QObject):
 
         command = "<%s,%d>" % (axisAndSpeed[0], axisAndSpeed[1])
         ardcom.sendCommand(command, self.ser)
+        if axisAndSpeed[0] == 'RA':
+            self.publishState(raSpeed=axisAndSpeed[1])
+        elif axisAndSpeed[0] == 'DEC':
+            self.publishState(decSpeed=axisAndSpeed[1])
+
+    def publishState(self, **fields):
+        """Publish the given mount state fields, if publication is enabled"""
+        
+        if self.mountState is not None:
+            self.mountState.publish(**fields)
+
+    def closeMountState(self):
+        if self.mountState is not None:
+            self.mountState.close()
+            self.mountState = None
 #
 #    @pyqtSlot()
 #    def close(self, ser):
@@ -487,6 +505,202 @@ class Backend(QtCore.QObject):
 #        frontend.set_reference_signal.connect(self.set_reference)
         frontend.closeSerialSignal.connect(self.closeSerial)
 
+class QtSerialBackend(Backend):
+    """Backend that talks to the Arduino through QSerialPort
+    
+    Everything runs in the Qt event loop: replies are parsed when readyRead
+    is emitted, writes don't block and a QTimer gives up on a command when
+    its reply doesn't arrive. Commands are sent one at a time, the next one 
+    goes out when the reply to the previous one is received. If a command 
+    for an axis is still waiting to be sent, a newer one for the same axis 
+    replaces it. A command whose reply timed out is remembered per axis: 
+    if its reply arrives late, the speed it set is published.
+    
+    Start the GUI with --qtserial to use it.
+    """
+
+    readyTimeout = 5000 # in milliseconds, wait for "Arduino is ready"
+    ackTimeout = 2000 # in milliseconds, wait for the reply to a command
+
+    def __init__(self, *args, **kwargs):
+        # checked first, so no mount state segment is created for nothing
+        if QSerialPort is None:
+            raise EnvironmentError('PyQt5.QtSerialPort is not available')
+        super(QtSerialBackend, self).__init__(*args, **kwargs)
+        
+        self.ser = None
+        self.serialParams = None
+        self.rxBuffer = bytearray()
+        self.arduinoReady = False
+        self.pendingCommands = [] # list of [axis, speed]
+        self.waitingCommand = None # [axis, speed] sent, waiting for reply
+        self.lateCommands = {} # axis: speed of a command whose reply timed out
+        
+        self.readyTimer = QtCore.QTimer(self)
+        self.readyTimer.setSingleShot(True)
+        self.readyTimer.timeout.connect(self.readyTimedOut)
+        self.ackTimer = QtCore.QTimer(self)
+        self.ackTimer.setSingleShot(True)
+        self.ackTimer.timeout.connect(self.ackTimedOut)
+
+    @pyqtSlot(list)
+    def connectSerial(self, serialParams):
+        # serialParams is a list containing
+        # port (string) at serialParams[0]
+        # baud rate (int) at serialParams[1]
+        if self.ser is not None:
+            if self.ser.isOpen():
+                self.closeSerial()
+            self.ser.deleteLater()
+        self.serialParams = serialParams
+        self.rxBuffer = bytearray()
+        self.arduinoReady = False
+        self.pendingCommands = []
+        self.waitingCommand = None
+        self.lateCommands = {}
+        
+        self.ser = QSerialPort(self)
+        self.ser.setPortName(serialParams[0])
+        self.ser.setBaudRate(serialParams[1])
+        self.ser.readyRead.connect(self.readData)
+        opened = self.ser.open(QtCore.QIODevice.ReadWrite)
+        print('\nSerial port opened:', opened, '\n')
+        if not opened:
+            print('Error opening serial port:', self.ser.errorString())
+            return
+        self.readyTimer.start(self.readyTimeout)
+
+    @pyqtSlot()
+    def closeSerial(self):
+        self.readyTimer.stop()
+        self.ackTimer.stop()
+        self.pendingCommands = []
+        self.waitingCommand = None
+        self.lateCommands = {}
+        self.arduinoReady = False
+        if self.ser is not None:
+            self.ser.close()
+            print('\nSerial port opened:', self.ser.isOpen(), '\n')
+        self.publishState(connected=False)
+
+    def setSpeed(self, axisAndSpeed):
+        """Queue the speed of a given axis, it is sent as soon as possible"""
+        
+        for pending in self.pendingCommands:
+            if pending[0] == axisAndSpeed[0]:
+                pending[1] = axisAndSpeed[1]
+                break
+        else:
+            self.pendingCommands.append([axisAndSpeed[0], axisAndSpeed[1]])
+        self.sendNextCommand()
+
+    def sendNextCommand(self):
+        if not self.arduinoReady or self.waitingCommand is not None:
+            return
+        if not self.pendingCommands:
+            return
+        self.waitingCommand = self.pendingCommands.pop(0)
+        command = "<%s,%d>" % (self.waitingCommand[0], self.waitingCommand[1])
+        self.ser.write(command.encode('utf-8'))
+        print ("Command sent: " + command)
+        self.ackTimer.start(self.ackTimeout)
+
+    @pyqtSlot()
+    def readData(self):
+        self.rxBuffer += bytes(self.ser.readAll())
+        
+        # extract every complete <...> frame, bytes outside frames are dropped
+        while True:
+            start = self.rxBuffer.find(b'<')
+            if start == -1:
+                self.rxBuffer = bytearray()
+                return
+            end = self.rxBuffer.find(b'>', start)
+            if end == -1:
+                del self.rxBuffer[:start]
+                return
+            frame = self.rxBuffer[start + 1:end].decode('utf-8', 'replace')
+            del self.rxBuffer[:end + 1]
+            self.processFrame(frame)
+
+    def processFrame(self, frame):
+        if frame.find("Arduino is ready") != -1:
+            print (frame)
+            print ()
+            self.readyTimer.stop()
+            if self.arduinoReady:
+                self.arduinoReset()
+            self.setArduinoReady()
+            return
+        if not self.arduinoReady:
+            return
+        
+        if self.waitingCommand is not None:
+            command = "<%s,%d>" % (self.waitingCommand[0], self.waitingCommand[1])
+            if ardcom.isReplyTo(frame, command):
+                self.ackTimer.stop()
+                print ("Reply Received: " + frame)
+                print ("===========\n")
+                axis, speed = self.waitingCommand
+                self.waitingCommand = None
+                self.lateCommands.pop(axis, None)
+                self.publishSpeed(axis, speed)
+                self.sendNextCommand()
+                return
+        
+        # the Arduino applied a command after its reply timed out
+        for axis, speed in list(self.lateCommands.items()):
+            if ardcom.isReplyTo(frame, "<%s,%d>" % (axis, speed)):
+                print ("Late reply received: " + frame)
+                del self.lateCommands[axis]
+                self.publishSpeed(axis, speed)
+                return
+        
+        print ("Unexpected reply ignored: " + frame)
+
+    def publishSpeed(self, axis, speed):
+        if axis == 'RA':
+            self.publishState(raSpeed=speed)
+        elif axis == 'DEC':
+            self.publishState(decSpeed=speed)
+
+    def arduinoReset(self):
+        """The board restarted: its motors are stopped and the command 
+        waiting for a reply was lost, so it goes back to the pending list"""
+        
+        print('Arduino was reset. Resending pending commands.')
+        self.ackTimer.stop()
+        if self.waitingCommand is not None:
+            axis = self.waitingCommand[0]
+            if all(pending[0] != axis for pending in self.pendingCommands):
+                self.pendingCommands.insert(0, self.waitingCommand)
+            self.waitingCommand = None
+        self.lateCommands = {}
+        self.arduinoReady = False
+        self.publishState(raSpeed=0, decSpeed=0)
+
+    def setArduinoReady(self):
+        self.arduinoReady = True
+        self.publishState(connected=True, port=self.serialParams[0],
+                          baudRate=self.serialParams[1])
+        self.sendNextCommand()
+
+    @pyqtSlot()
+    def readyTimedOut(self):
+        # the board may not reset when the port is opened
+        print('\nNo "Arduino is ready" message after %d ms. '
+              'Sending commands anyway.' % self.readyTimeout)
+        self.setArduinoReady()
+
+    @pyqtSlot()
+    def ackTimedOut(self):
+        command = "<%s,%d>" % (self.waitingCommand[0], self.waitingCommand[1])
+        print('\nNo reply to %s after %d ms.' % (command, self.ackTimeout))
+        # the Arduino may still apply it, a late reply is accepted
+        self.lateCommands[self.waitingCommand[0]] = self.waitingCommand[1]
+        self.waitingCommand = None
+        self.sendNextCommand()
+
 # Define main
 
 if __name__ == '__main__':
@@ -499,15 +713,32 @@ if __name__ == '__main__':
     app.setPalette(darkPalette)
     
     gui = Frontend()   
-    worker = Backend()
+    
+    # --qtserial: event-driven QSerialPort backend in the GUI thread
+    # default: pyserial backend in its own thread
+    worker = None
+    if '--qtserial' in sys.argv:
+        try:
+            worker = QtSerialBackend()
+        except EnvironmentError as e:
+            print('\n%s. Using pyserial instead.' % e)
+    if worker is None:
+        worker = Backend()
 
     worker.make_connection(gui)
 
-    telescopeControlThread = QtCore.QThread()
-    worker.moveToThread(telescopeControlThread)
-    telescopeControlThread.start()
+    if not isinstance(worker, QtSerialBackend):
+        telescopeControlThread = QtCore.QThread()
+        worker.moveToThread(telescopeControlThread)
+        telescopeControlThread.start()
 
     gui.show()
     app.exec_()
     
+    # no queued slot may publish once the segment is closed
+    if not isinstance(worker, QtSerialBackend):
+        telescopeControlThread.quit()
+        telescopeControlThread.wait()
+    worker.closeMountState()
+    
 #    sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for MountState.py
+
+Every test uses its own segment name so a running telescope_gui is never
+touched. Dead and live writers are simulated by writing the process id of a
+finished or of a running child process into the segment header.
+
+Run with:
+       python -m unittest test_MountState
+
+@author: Mariano Barella
+marianobarella@gmail.com
+
+"""
+
+import os
+import sys
+import time
+import subprocess
+import unittest
+
+import MountState as ms
+
+#=====================================
+
+#  Helpers
+
+#=====================================
+
+def deadPid():
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    return child.pid
+
+def setHeader(writer, seq=None, pid=None, version=None):
+    segMagic, segVersion, reserved, segSeq, segPid = ms.headerStruct.unpack_from(writer.shm.buf, 0)
+    ms.headerStruct.pack_into(writer.shm.buf, 0, segMagic,
+                              segVersion if version is None else version,
+                              reserved,
+                              segSeq if seq is None else seq,
+                              segPid if pid is None else pid)
+
+def abandon(writer):
+    """Forget a writer as if its process died (the segment is kept)"""
+    writer.buf = None
+    writer.shm.close()
+
+@unittest.skipIf(ms.shared_memory is None, 'Shared memory requires Python 3.8')
+class MountStateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'test_mount_state_%d_%s' % (os.getpid(), self._testMethodName)
+        self.writers = []
+        self.readers = []
+
+    def tearDown(self):
+        for reader in self.readers:
+            if reader.buf is not None:
+                reader.close()
+        for writer in self.writers:
+            writer.close()
+        try:
+            shm = ms.shared_memory.SharedMemory(self.name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+    def writer(self):
+        writer = ms.MountStateWriter(self.name)
+        self.writers.append(writer)
+        return writer
+
+    def reader(self):
+        reader = ms.MountStateReader(self.name)
+        self.readers.append(reader)
+        return reader
+
+    # Seqlock ------------------------------------------------------------------
+
+    def test_publish_and_read(self):
+        writer = self.writer()
+        writer.publish(raSpeed=57, connected=True, port='/dev/ttyACM0', baudRate=9600)
+        writer.publish(decSpeed=-10)
+        state = self.reader().read()
+        self.assertEqual((state.raSpeed, state.decSpeed, state.connected,
+                          state.port, state.baudRate), (57, -10, True, '/dev/ttyACM0', 9600))
+        self.assertEqual(state.sequence % 2, 0)
+        self.assertEqual(state.writerPid, os.getpid())
+
+    def test_sequence_changes_on_every_publish(self):
+        writer = self.writer()
+        reader = self.reader()
+        seq = reader.sequence()
+        writer.publish(raSpeed=1)
+        self.assertEqual(reader.sequence(), seq + 2)
+
+    def test_read_times_out_while_update_in_progress(self):
+        writer = self.writer()
+        reader = self.reader()
+        setHeader(writer, seq=writer.seq + 1)
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            reader.read(timeout=0.05)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_unknown_field(self):
+        with self.assertRaises(KeyError):
+            self.writer().publish(focus=3)
+
+    # Close --------------------------------------------------------------------
+
+    def test_close_publishes_disconnected_state(self):
+        writer = ms.MountStateWriter(self.name)
+        writer.publish(raSpeed=57, decSpeed=3, connected=True)
+        reader = self.reader()
+        self.assertTrue(reader.writerAlive())
+        writer.close()
+        state = reader.read()
+        self.assertEqual((state.raSpeed, state.decSpeed, state.connected), (0, 0, False))
+        self.assertEqual(state.writerPid, 0)
+        self.assertFalse(reader.writerAlive())
+        # publishing after close does nothing
+        writer.publish(raSpeed=5)
+
+    # Takeover -----------------------------------------------------------------
+
+    def test_second_writer_in_same_process_is_refused(self):
+        self.writer()
+        with self.assertRaises(EnvironmentError):
+            ms.MountStateWriter(self.name)
+
+    def test_live_writer_is_refused(self):
+        child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+        try:
+            writer = self.writer()
+            setHeader(writer, pid=child.pid)
+            abandon(writer)
+            self.writers.remove(writer)
+            with self.assertRaisesRegex(EnvironmentError, 'process %d' % child.pid):
+                ms.MountStateWriter(self.name)
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_dead_writer_is_taken_over(self):
+        writer = self.writer()
+        writer.publish(raSpeed=57)
+        setHeader(writer, pid=deadPid())
+        abandon(writer)
+        self.writers.remove(writer)
+        newWriter = self.writer()
+        state = self.reader().read()
+        self.assertEqual(state.writerPid, os.getpid())
+        self.assertEqual(state.raSpeed, 0)
+
+    def test_takeover_continues_odd_sequence(self):
+        writer = self.writer()
+        setHeader(writer, seq=7, pid=deadPid())
+        abandon(writer)
+        self.writers.remove(writer)
+        newWriter = self.writer()
+        # 7 rounded up to 8, then the first publish
+        self.assertEqual(newWriter.seq, 10)
+        self.assertEqual(self.reader().read().sequence, 10)
+
+    def test_layout_version_mismatch(self):
+        writer = self.writer()
+        setHeader(writer, version=ms.layoutVersion - 1, pid=deadPid())
+        with self.assertRaisesRegex(ValueError, 'layout version'):
+            ms.MountStateReader(self.name)
+        abandon(writer)
+        self.writers.remove(writer)
+        with self.assertRaisesRegex(ValueError, 'layout version'):
+            ms.MountStateWriter(self.name)
+
+    def test_segment_of_another_program(self):
+        shm = ms.shared_memory.SharedMemory(self.name, create=True, size=ms.segmentSize)
+        shm.buf[0:4] = b'ABCD'
+        shm.close()
+        with self.assertRaisesRegex(ValueError, 'another program'):
+            ms.MountStateWriter(self.name)
+        with self.assertRaisesRegex(ValueError, 'not a mount state'):
+            ms.MountStateReader(self.name)
+
+#======================================
+
+if __name__ == '__main__':
+    unittest.main()
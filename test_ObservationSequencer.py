@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for ObservationSequencer.py
+
+compilePlan is checked on its own. The sequencer runs against FakeArduino,
+a stand-in for the serial port that answers like ra_and_dec_control.ino:
+a "< Axis RA newVel 50 Time 0 s >" reply followed by a status line.
+
+Run with:
+       python -m unittest test_ObservationSequencer
+
+@author: Mariano Barella
+marianobarella@gmail.com
+
+"""
+
+import time
+import threading
+import unittest
+
+import ObservationSequencer as seq
+
+#=====================================
+
+#  Fake serial port
+
+#=====================================
+
+class FakeArduino(object):
+    """Replies are available delay seconds after the command is written"""
+
+    def __init__(self, dropReplies=(), delay=0.0, baudrate=9600):
+        self.baudrate = baudrate
+        self.timeout = 0.01
+        self.delay = delay
+        self.rx = bytearray()
+        self.delayed = [] # [time the bytes become available, bytes]
+        self.lock = threading.Lock()
+        self.speeds = {'RA': 0, 'DEC': 0}
+        self.commands = []
+        self.writeTimes = []
+        self.dropReplies = dropReplies
+
+    def write(self, data):
+        command = data.decode('utf-8')
+        axis, speed = command[1:-1].split(',')
+        self.commands.append(command)
+        self.writeTimes.append(time.perf_counter())
+        if axis in self.speeds:
+            self.speeds[axis] = int(speed)
+        if command in self.dropReplies:
+            return len(data)
+        reply = "< Axis %s newVel %s Time 0 s >\r\n" % (axis, speed)
+        if axis in self.speeds:
+            reply += "Moving %s\r\n" % axis
+        with self.lock:
+            self.delayed.append([time.perf_counter() + self.delay,
+                                 reply.encode('utf-8')])
+        return len(data)
+
+    def read(self, size=1):
+        with self.lock:
+            now = time.perf_counter()
+            while self.delayed and self.delayed[0][0] <= now:
+                self.rx += self.delayed.pop(0)[1]
+            if self.rx:
+                x = bytes(self.rx[:size])
+                del self.rx[:size]
+                return x
+        time.sleep(self.timeout)
+        return b''
+
+def waitFor(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+#=====================================
+
+#  compilePlan
+
+#=====================================
+
+class CompilePlanTest(unittest.TestCase):
+
+    def commands(self, timeline):
+        return [(entry.time, entry.command) for entry in timeline]
+
+    def test_nudge_restores_previous_speed(self):
+        timeline, duration = seq.compilePlan([
+            {'action': 'track', 'axis': 'DEC', 'speed': 20, 'duration': 5},
+            {'action': 'nudge', 'axis': 'DEC', 'speed': -10, 'duration': 4}])
+        self.assertEqual(self.commands(timeline),
+                         [(0.0, '<DEC,20>'), (5.0, '<DEC,-10>'), (9.0, '<DEC,20>')])
+        self.assertEqual(duration, 9.0)
+
+    def test_stop_without_axis_stops_both(self):
+        timeline, duration = seq.compilePlan({'steps': [
+            {'action': 'track', 'axis': 'RA', 'speed': 57},
+            {'action': 'track', 'axis': 'DEC', 'speed': 3, 'duration': 2},
+            {'action': 'stop'}]})
+        self.assertEqual(self.commands(timeline)[-2:],
+                         [(2.0, '<RA,0>'), (2.0, '<DEC,0>')])
+        self.assertEqual((timeline[-1].raSpeed, timeline[-1].decSpeed), (0, 0))
+
+    def test_stop_one_axis(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 57},
+            {'action': 'track', 'axis': 'DEC', 'speed': 3, 'duration': 2},
+            {'action': 'stop', 'axis': 'DEC'}])
+        self.assertEqual(self.commands(timeline)[-1], (2.0, '<DEC,0>'))
+        self.assertEqual(timeline[-1].raSpeed, 57)
+
+    def test_same_time_keeps_last_command(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 50},
+            {'action': 'track', 'axis': 'DEC', 'speed': 5},
+            {'action': 'track', 'axis': 'RA', 'speed': 60}])
+        self.assertEqual(self.commands(timeline), [(0.0, '<DEC,5>'), (0.0, '<RA,60>')])
+        self.assertEqual((timeline[-1].raSpeed, timeline[-1].decSpeed), (60, 5))
+
+    def test_same_time_back_to_previous_speed_is_dropped(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 50, 'duration': 0},
+            {'action': 'track', 'axis': 'RA', 'speed': 0}])
+        self.assertEqual(timeline, [])
+
+    def test_unchanged_speed_is_dropped(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 50, 'duration': 1},
+            {'action': 'track', 'axis': 'RA', 'speed': 50, 'duration': 1},
+            {'action': 'stop', 'axis': 'DEC'}])
+        self.assertEqual(self.commands(timeline), [(0.0, '<RA,50>')])
+
+    def test_integral_float_speed_is_accepted(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 57.0, 'duration': 1.5}])
+        self.assertEqual(self.commands(timeline), [(0.0, '<RA,57>')])
+
+    def test_speed_is_clamped_by_checkSpeed(self):
+        timeline, _ = seq.compilePlan([
+            {'action': 'track', 'axis': 'RA', 'speed': 300},
+            {'action': 'track', 'axis': 'DEC', 'speed': -300}])
+        self.assertEqual([entry.speed for entry in timeline], [255, -255])
+
+    def test_validation_errors(self):
+        badPlans = [
+            ('list of steps', {'steps': 'track'}),
+            ('list of steps', 42),
+            ('action', [{'action': 'fly'}]),
+            ('action', [{'axis': 'RA', 'speed': 1}]),
+            ('action', ['track']),
+            ('axis', [{'action': 'track', 'speed': 1}]),
+            ('axis', [{'action': 'track', 'axis': 'AZ', 'speed': 1}]),
+            ('axis', [{'action': 'stop', 'axis': 'ra'}]),
+            ('speed', [{'action': 'track', 'axis': 'RA'}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': 'fast'}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': float('inf')}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': float('nan')}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': 57.9}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': 0.5}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': True}]),
+            ('speed', [{'action': 'nudge', 'axis': 'RA', 'speed': False, 'duration': 1}]),
+            ('speed', [{'action': 'track', 'axis': 'RA', 'speed': '57'}]),
+            ('needs a duration', [{'action': 'nudge', 'axis': 'RA', 'speed': 1}]),
+            ('needs a duration', [{'action': 'wait'}]),
+            ('positive', [{'action': 'nudge', 'axis': 'RA', 'speed': 1, 'duration': 0}]),
+            ('positive', [{'action': 'wait', 'duration': -1}]),
+            ('positive', [{'action': 'stop', 'duration': -1}]),
+            ('number', [{'action': 'wait', 'duration': 'long'}]),
+            ('number', [{'action': 'wait', 'duration': True}]),
+            ('number', [{'action': 'track', 'axis': 'RA', 'speed': 1, 'duration': False}]),
+            ('number', [{'action': 'wait', 'duration': '10'}]),
+            ('finite', [{'action': 'wait', 'duration': float('nan')}]),
+            ('finite', [{'action': 'track', 'axis': 'RA', 'speed': 1,
+                         'duration': float('inf')}]),
+        ]
+        for message, plan in badPlans:
+            with self.subTest(plan=plan):
+                with self.assertRaisesRegex(ValueError, message):
+                    seq.compilePlan(plan)
+
+#=====================================
+
+#  ObservationSequencer
+
+#=====================================
+
+class SequencerTest(unittest.TestCase):
+
+    def makeSequencer(self, plan, latency=0.0, **kwargs):
+        timeline, duration = seq.compilePlan(plan)
+        arduino = FakeArduino(**kwargs)
+        sequencer = seq.ObservationSequencer(timeline, duration, arduino,
+                                             latency=latency, replyTimeout=0.3)
+        return sequencer, arduino
+
+    def test_commands_are_sent_early_by_the_latency(self):
+        # at 1 Mbaud the reply takes ~0.3 ms, so the link time is ~ the delay
+        delay = 0.03
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57, 'duration': 0.1},
+            {'action': 'track', 'axis': 'DEC', 'speed': 5, 'duration': 0.1},
+            {'action': 'track', 'axis': 'RA', 'speed': 60, 'duration': 0.1},
+            {'action': 'stop', 'axis': 'RA'}], latency=delay, delay=delay,
+            baudrate=1000000)
+        sequencer.start()
+        sequencer.join(3)
+        self.assertFalse(sequencer.isRunning())
+        self.assertEqual(len(sequencer.records), 4)
+        self.assertAlmostEqual(sequencer.latency, delay, delta=0.01)
+        # the first command is due at 0, it can't be sent earlier
+        for record in sequencer.records[1:]:
+            self.assertAlmostEqual(record['latency'], delay, delta=0.01)
+            # sent ahead of time by the latency and executed on time
+            self.assertAlmostEqual(record['sent'],
+                                   record['scheduled'] - record['latency'], delta=0.005)
+            self.assertAlmostEqual(record['executed'], record['scheduled'], delta=0.01)
+            self.assertLess(record['sent'], record['scheduled'] - delay / 2)
+        report = sequencer.timingReport()
+        self.assertLess(max(abs(e) for e in report['errors'][1:]), 10)
+
+    def test_port_without_timeout_gets_one(self):
+        arduino = FakeArduino()
+        arduino.timeout = None
+        seq.ObservationSequencer([], 0.0, arduino)
+        self.assertEqual(arduino.timeout, 0.1)
+
+    def test_runs_timeline(self):
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57, 'duration': 0.05},
+            {'action': 'nudge', 'axis': 'DEC', 'speed': -10, 'duration': 0.05},
+            {'action': 'stop'}])
+        sequencer.start()
+        sequencer.join(2)
+        self.assertFalse(sequencer.isRunning())
+        self.assertEqual(arduino.commands, ['<RA,57>', '<DEC,-10>', '<RA,0>', '<DEC,0>'])
+        report = sequencer.timingReport()
+        self.assertEqual(report['commands'], 4)
+        self.assertIn('reply transmission time (9600 baud)', report['method'])
+        for record in sequencer.records:
+            self.assertLessEqual(record['sent'], record['executed'])
+            self.assertLessEqual(record['executed'], record['replied'])
+
+    def test_pause_and_resume(self):
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57, 'duration': 0.1},
+            {'action': 'track', 'axis': 'DEC', 'speed': 5, 'duration': 0.05}])
+        sequencer.start()
+        self.assertTrue(waitFor(lambda: arduino.speeds['RA'] == 57))
+        sequencer.pause()
+        self.assertTrue(waitFor(lambda: arduino.speeds['RA'] == 0))
+        time.sleep(0.2)
+        self.assertEqual(arduino.speeds, {'RA': 0, 'DEC': 0})
+        sequencer.resume()
+        sequencer.join(2)
+        self.assertFalse(sequencer.isRunning())
+        self.assertEqual(arduino.speeds, {'RA': 57, 'DEC': 5})
+        self.assertGreaterEqual(sequencer.pausedTime, 0.2)
+        # the DEC command was shifted by the pause
+        self.assertGreaterEqual(sequencer.records[-1]['scheduled'], 0.3)
+
+    def test_abort_stops_both_axes(self):
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57},
+            {'action': 'track', 'axis': 'DEC', 'speed': 5, 'duration': 60},
+            {'action': 'stop'}])
+        sequencer.start()
+        self.assertTrue(waitFor(lambda: arduino.speeds['DEC'] == 5))
+        sequencer.abort()
+        sequencer.join(2)
+        self.assertFalse(sequencer.isRunning())
+        self.assertEqual(arduino.speeds, {'RA': 0, 'DEC': 0})
+        self.assertEqual(arduino.commands[-2:], ['<RA,0>', '<DEC,0>'])
+
+    def test_abort_while_paused(self):
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57, 'duration': 60}])
+        sequencer.start()
+        self.assertTrue(waitFor(lambda: arduino.speeds['RA'] == 57))
+        sequencer.pause()
+        self.assertTrue(waitFor(lambda: arduino.speeds['RA'] == 0))
+        sequencer.abort()
+        sequencer.join(2)
+        self.assertFalse(sequencer.isRunning())
+        self.assertEqual(arduino.speeds, {'RA': 0, 'DEC': 0})
+
+    def test_lost_reply_aborts_and_stops(self):
+        sequencer, arduino = self.makeSequencer([
+            {'action': 'track', 'axis': 'RA', 'speed': 57, 'duration': 0.05},
+            {'action': 'track', 'axis': 'DEC', 'speed': 5, 'duration': 60}],
+            dropReplies=('<DEC,5>',))
+        sequencer.start()
+        sequencer.join(2)
+        self.assertFalse(sequencer.isRunning())
+        self.assertTrue(sequencer.abortFlag)
+        self.assertEqual(arduino.speeds, {'RA': 0, 'DEC': 0})
+
+    def test_measure_latency(self):
+        sequencer, arduino = self.makeSequencer([])
+        latency = sequencer.measureLatency(3)
+        self.assertEqual(arduino.commands, ['<PING,0>'] * 3)
+        self.assertGreaterEqual(latency, 0.0)
+        self.assertEqual(arduino.speeds, {'RA': 0, 'DEC': 0})
+
+#======================================
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for telescope_gui.QtSerialBackend
+
+The backend is driven without a board: FakePort stands for the QSerialPort
+(bytes written are recorded, bytes received are given to readData) and
+FakeWriter records what would be published to the shared mount state.
+Timers are not run, their slots (ackTimedOut, readyTimedOut) are called
+directly.
+
+If PyQt5 or pyqtgraph are not installed, minimal stand-ins of the few Qt
+names used by telescope_gui are loaded so these tests still run.
+
+Run with:
+       python -m unittest test_QtSerialBackend
+
+@author: Mariano Barella
+marianobarella@gmail.com
+
+"""
+
+import sys
+import types
+import unittest
+from unittest import mock
+
+#=====================================
+
+#  Qt stand-ins, only when Qt is missing
+
+#=====================================
+
+def installQtStubs():
+
+    class Signal(object):
+        def __init__(self, *args):
+            self.slots = []
+        def connect(self, slot):
+            self.slots.append(slot)
+        def emit(self, *args):
+            for slot in self.slots:
+                slot(*args)
+
+    def pyqtSlot(*args):
+        return lambda function: function
+
+    class QObject(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+    class QTimer(QObject):
+        def __init__(self, *args):
+            self.timeout = Signal()
+            self.active = False
+        def setSingleShot(self, singleShot):
+            pass
+        def start(self, interval=0):
+            self.active = True
+        def stop(self):
+            self.active = False
+        def isActive(self):
+            return self.active
+
+    class Placeholder(object):
+        def __init__(self, *args, **kwargs):
+            pass
+
+    qtCore = types.ModuleType('PyQt5.QtCore')
+    qtCore.pyqtSignal = Signal
+    qtCore.pyqtSlot = pyqtSlot
+    qtCore.QObject = QObject
+    qtCore.QTimer = QTimer
+    qtCore.QThread = Placeholder
+    qtCore.QIODevice = types.SimpleNamespace(ReadWrite=3)
+    qtGui = types.ModuleType('pyqtgraph.Qt.QtGui')
+    qtGui.QFrame = Placeholder
+    qtSerialPort = types.ModuleType('PyQt5.QtSerialPort')
+    qtSerialPort.QSerialPort = Placeholder
+    dockarea = types.ModuleType('pyqtgraph.dockarea')
+    dockarea.DockArea = Placeholder
+    dockarea.Dock = Placeholder
+    pyqtgraphQt = types.ModuleType('pyqtgraph.Qt')
+    pyqtgraphQt.QtCore = qtCore
+    pyqtgraphQt.QtGui = qtGui
+
+    sys.modules.update({'PyQt5': types.ModuleType('PyQt5'),
+                        'PyQt5.QtCore': qtCore,
+                        'PyQt5.QtSerialPort': qtSerialPort,
+                        'pyqtgraph': types.ModuleType('pyqtgraph'),
+                        'pyqtgraph.Qt': pyqtgraphQt,
+                        'pyqtgraph.dockarea': dockarea})
+
+try:
+    import PyQt5.QtCore
+    import PyQt5.QtSerialPort
+    import pyqtgraph.dockarea
+    app = PyQt5.QtCore.QCoreApplication.instance() or PyQt5.QtCore.QCoreApplication([])
+except ImportError:
+    installQtStubs()
+
+import telescope_gui
+
+#=====================================
+
+#  Fakes
+
+#=====================================
+
+class FakePort(object):
+
+    def __init__(self):
+        self.written = []
+        self.received = b''
+        self.opened = True
+
+    def write(self, data):
+        self.written.append(bytes(data).decode('utf-8'))
+        return len(data)
+
+    def readAll(self):
+        data = self.received
+        self.received = b''
+        return data
+
+    def isOpen(self):
+        return self.opened
+
+    def close(self):
+        self.opened = False
+
+class FakeWriter(object):
+
+    instances = 0
+
+    def __init__(self, *args):
+        FakeWriter.instances += 1
+        self.state = {}
+        self.history = []
+
+    def publish(self, **fields):
+        self.state.update(fields)
+        self.history.append(fields)
+
+    def close(self):
+        pass
+
+#=====================================
+
+#  Tests
+
+#=====================================
+
+class QtSerialBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(telescope_gui.MountState, 'MountStateWriter', FakeWriter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = telescope_gui.QtSerialBackend()
+        self.backend.serialParams = ['/dev/ttyFAKE', 9600]
+        self.port = FakePort()
+        self.backend.ser = self.port
+        self.state = self.backend.mountState.state
+
+    def receive(self, *chunks):
+        for chunk in chunks:
+            self.port.received += chunk.encode('utf-8')
+            self.backend.readData()
+
+    def makeReady(self):
+        self.receive('<Arduino is ready>\r\n')
+        self.assertTrue(self.backend.arduinoReady)
+
+    def reply(self, axis, speed):
+        self.receive('< Axis %s newVel %d Time 0 s >\r\nMoving %s\r\n' % (axis, speed, axis))
+
+    # readData -----------------------------------------------------------------
+
+    def test_ready_frame_split_across_reads(self):
+        self.receive('garbage<Arduino is', ' rea', 'dy>\r\n')
+        self.assertTrue(self.backend.arduinoReady)
+        self.assertEqual(self.state['connected'], True)
+        self.assertEqual(self.state['port'], '/dev/ttyFAKE')
+
+    def test_reply_split_and_status_lines_between_frames(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 57])
+        self.backend.setSpeed(['DEC', -5])
+        self.assertEqual(self.port.written, ['<RA,57>'])
+        self.receive('< Axis RA ne', 'wVel 57 Time 0 s >\r\nMoving RA forward\r\n< Axis D',
+                     'EC newVel -5 Time 0 s >\r\nMoving DEC backward\r\n')
+        self.assertEqual(self.port.written, ['<RA,57>', '<DEC,-5>'])
+        self.assertEqual((self.state['raSpeed'], self.state['decSpeed']), (57, -5))
+        self.assertIsNone(self.backend.waitingCommand)
+        self.assertEqual(self.backend.rxBuffer, bytearray())
+
+    # Queue --------------------------------------------------------------------
+
+    def test_only_latest_pending_command_per_axis(self):
+        self.backend.setSpeed(['RA', 10])
+        self.backend.setSpeed(['DEC', 5])
+        self.backend.setSpeed(['RA', 20])
+        self.assertEqual(self.port.written, [])
+        self.makeReady()
+        self.assertEqual(self.port.written, ['<RA,20>'])
+        self.reply('RA', 20)
+        self.assertEqual(self.port.written, ['<RA,20>', '<DEC,5>'])
+
+    def test_one_command_at_a_time(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 10])
+        self.backend.setSpeed(['RA', 11])
+        self.backend.setSpeed(['RA', 12])
+        self.assertEqual(self.port.written, ['<RA,10>'])
+        self.reply('RA', 10)
+        self.assertEqual(self.port.written, ['<RA,10>', '<RA,12>'])
+
+    def test_ready_timeout_sends_pending_commands(self):
+        self.backend.setSpeed(['DEC', 7])
+        self.backend.readyTimedOut()
+        self.assertEqual(self.port.written, ['<DEC,7>'])
+
+    # processFrame -------------------------------------------------------------
+
+    def test_reply_must_match_waiting_command(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 57])
+        self.reply('RA', 56)
+        self.reply('DEC', 57)
+        self.assertEqual(self.backend.waitingCommand, ['RA', 57])
+        self.assertNotIn('raSpeed', self.state)
+        self.reply('RA', 57)
+        self.assertIsNone(self.backend.waitingCommand)
+        self.assertEqual(self.state['raSpeed'], 57)
+
+    def test_late_reply_after_timeout_is_published(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 57])
+        self.reply('RA', 57)
+        self.backend.setSpeed(['RA', 3])
+        self.backend.setSpeed(['DEC', 5])
+        self.backend.ackTimedOut()
+        self.assertEqual(self.port.written[-1], '<DEC,5>')
+        self.assertEqual(self.state['raSpeed'], 57)
+        self.reply('RA', 3)
+        self.assertEqual(self.state['raSpeed'], 3)
+        self.assertEqual(self.backend.waitingCommand, ['DEC', 5])
+        self.reply('DEC', 5)
+        self.assertEqual(self.state['decSpeed'], 5)
+
+    def test_late_reply_is_accepted_once(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 3])
+        self.backend.ackTimedOut()
+        self.reply('RA', 3)
+        self.backend.mountState.history = []
+        self.reply('RA', 3)
+        self.assertEqual(self.backend.mountState.history, [])
+
+    def test_reset_resends_unacknowledged_command(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 57])
+        self.reply('RA', 57)
+        self.backend.setSpeed(['DEC', 5])
+        self.receive('<Arduino is ready>\r\n')
+        self.assertEqual((self.state['raSpeed'], self.state['decSpeed']), (0, 0))
+        self.assertEqual(self.port.written, ['<RA,57>', '<DEC,5>', '<DEC,5>'])
+        self.assertEqual(self.backend.waitingCommand, ['DEC', 5])
+        self.reply('DEC', 5)
+        self.assertEqual(self.state['decSpeed'], 5)
+
+    def test_reset_keeps_newer_pending_command(self):
+        self.makeReady()
+        self.backend.setSpeed(['RA', 10])
+        self.backend.setSpeed(['RA', 20])
+        self.receive('<Arduino is ready>\r\n')
+        self.assertEqual(self.port.written, ['<RA,10>', '<RA,20>'])
+
+    # Construction -------------------------------------------------------------
+
+    def test_missing_qserialport_creates_no_segment(self):
+        FakeWriter.instances = 0
+        with mock.patch.object(telescope_gui, 'QSerialPort', None):
+            with self.assertRaises(EnvironmentError):
+                telescope_gui.QtSerialBackend()
+        self.assertEqual(FakeWriter.instances, 0)
+
+#======================================
+
+if __name__ == '__main__':
+    unittest.main()